@@ -1,17 +1,24 @@
 import os
 import json
+import time
 import logging
+import functools
+import itertools
+import concurrent.futures
+from datetime import datetime, timedelta, timezone
 from dotenv import load_dotenv
 
-from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton, KeyboardButton, ReplyKeyboardMarkup
+from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton, KeyboardButton, ReplyKeyboardMarkup, InputMediaPhoto
 from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, ContextTypes, filters
 from telegram.constants import ParseMode
+from telegram.request import HTTPXRequest
+from telegram.error import BadRequest
 
 # НОВЫЕ ИМПОРТЫ ДЛЯ FIREBASE И WEBHOOKS
-import firebase_admin
 from firebase_admin import credentials, firestore
 from flask import Flask, request, jsonify 
 import asyncio # Для асинхронных операций в синхронной среде Flask
+import threading
 
 
 # --- 1. НАСТРОЙКА ---
@@ -34,65 +41,248 @@ except (ValueError, TypeError):
 
 FIREBASE_CONFIG = os.getenv("FIREBASE_CONFIG_JSON") 
 
-if not FIREBASE_CONFIG:
-    # --- ЛОКАЛЬНОЕ ТЕСТИРОВАНИЕ ---
-    try:
-        # ⚠️ ИЗМЕНИТЕ ПУТЬ К ВАШЕМУ JSON-КЛЮЧУ
-        path_to_key = 'serviceAccountKey.json' 
-        cred = credentials.Certificate(path_to_key)
-    except Exception as e:
-         raise EnvironmentError("❌ FIREBASE_CONFIG_JSON не задан, и локальный файл ключа Firebase не существует: " + str(e))
-else:
-    # --- ДЕПЛОЙ НА VERCEL ---
-    try:
-        cred_dict = json.loads(FIREBASE_CONFIG)
-        cred = credentials.Certificate(cred_dict)
-    except Exception as e:
-        raise ValueError(f"❌ Ошибка парсинга JSON Firebase из переменной окружения: {e}")
+# Сколько клиентов Firestore держать в пуле; у каждого свой gRPC-канал
+FIRESTORE_CHANNEL_POOL_SIZE = 4
 
-try:
-    firebase_admin.initialize_app(cred)
-except ValueError:
-    pass
-    
-db = firestore.client()
-submissions_collection = db.collection('submissions')
+@functools.lru_cache(maxsize=1)
+def _get_client_pool():
+    """Ленивая инициализация пула клиентов Firestore.
+
+    Выполняется при первом обращении к базе, поэтому холодный старт и
+    GET-проверки Vercel не тратят время на инициализацию Firebase.
+    """
+    if not FIREBASE_CONFIG:
+        # --- ЛОКАЛЬНОЕ ТЕСТИРОВАНИЕ ---
+        try:
+            # ⚠️ ИЗМЕНИТЕ ПУТЬ К ВАШЕМУ JSON-КЛЮЧУ
+            path_to_key = 'serviceAccountKey.json' 
+            cred = credentials.Certificate(path_to_key)
+        except Exception as e:
+             raise EnvironmentError("❌ FIREBASE_CONFIG_JSON не задан, и локальный файл ключа Firebase не существует: " + str(e))
+    else:
+        # --- ДЕПЛОЙ НА VERCEL ---
+        try:
+            cred_dict = json.loads(FIREBASE_CONFIG)
+            cred = credentials.Certificate(cred_dict)
+        except Exception as e:
+            raise ValueError(f"❌ Ошибка парсинга JSON Firebase из переменной окружения: {e}")
+
+    # Клиенты создаются явно (без firebase_admin.initialize_app): параллельные
+    # запросы из _FIRESTORE_POOL распределяются по нескольким каналам
+    google_cred = cred.get_credential()
+    clients = [
+        firestore.Client(project=cred.project_id, credentials=google_cred)
+        for _ in range(FIRESTORE_CHANNEL_POOL_SIZE)
+    ]
+    return itertools.cycle(clients)
+
+def _get_db():
+    """Следующий клиент Firestore из пула (по кругу)."""
+    return next(_get_client_pool())
+
+def _submissions_collection():
+    """Коллекция заявок."""
+    return _get_db().collection('submissions')
+
+# Флаг заявки -> коллекция-зеркало с документами {doc_id, createdAt}.
+# Избранных и отобранных мало, поэтому фильтрованные списки читаются из них,
+# а не фильтром по всей коллекции submissions.
+_MIRROR_COLLECTIONS = {
+    'favorite': 'favorites',
+    'selected': 'selected',
+}
 
 # --- 3. ФУНКЦИИ ДЛЯ РАБОТЫ С FIREBASE ---
 
 # Все функции здесь должны быть асинхронными, если не требуют обхода event loop
-# Однако, firebase-admin - это синхронный SDK. Мы будем вызывать его в асинхронных функциях
-# и полагаться на асинхронную природу python-telegram-bot и Flask.
+# Однако, firebase-admin - это синхронный SDK. Его вызовы выполняются в пуле потоков
+# (_run_blocking), чтобы не блокировать event loop и выполнять запросы параллельно.
+
+_FIRESTORE_POOL = concurrent.futures.ThreadPoolExecutor(max_workers=16, thread_name_prefix='firestore')
+
+async def _run_blocking(func, *args):
+    """Выполнение синхронного вызова Firestore в _FIRESTORE_POOL."""
+    return await asyncio.get_running_loop().run_in_executor(_FIRESTORE_POOL, func, *args)
+
+# Короткий кэш страниц заявок: при нажатиях подряд не читаем одно и то же.
+# Ключ — (filter_key, limit).
+_LIST_CACHE = {}
+_CACHE_TTL = 3.0
+
+# Число заявок (агрегация COUNT()) по filter_key; живёт _COUNT_TTL секунд
+# или до ближайшей записи
+_COUNT_CACHE = {}
+_COUNT_TTL = 10.0
+
+# Лимит Firestore на количество операций в одном WriteBatch
+BATCH_LIMIT = 500
+
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+def _invalidate_cache():
+    """Сброс кэшей страниц и счётчиков после любой записи в Firestore."""
+    _LIST_CACHE.clear()
+    _COUNT_CACHE.clear()
+
+def encode_cursor(created_at):
+    """createdAt -> микросекунды от эпохи (строка для callback_data)."""
+    if not isinstance(created_at, datetime):
+        # Например, SERVER_TIMESTAMP у только что сохранённой заявки
+        return ''
+    return str((created_at - _EPOCH) // timedelta(microseconds=1))
+
+def decode_cursor(value):
+    """Обратное преобразование encode_cursor; пустая строка -> None."""
+    if not value:
+        return None
+    return _EPOCH + timedelta(microseconds=int(value))
 
 async def save_submission_to_db(submission_data):
     """Сохранение новой заявки в Firestore."""
-    doc_ref = submissions_collection.document()
+    doc_ref = _submissions_collection().document()
     submission_data['doc_id'] = doc_ref.id 
-    doc_ref.set(submission_data) 
+    await _run_blocking(doc_ref.set, submission_data)
+    _invalidate_cache()
     return submission_data
 
-async def get_submissions_list(filter_key=None):
-    """Получение всех, избранных или отобранных заявок."""
-    query = submissions_collection
-    
-    if filter_key == 'favorite':
-        query = query.where('favorite', '==', True)
-    elif filter_key == 'selected':
-        query = query.where('selected', '==', True)
-        
-    query = query.order_by('createdAt', direction=firestore.Query.DESCENDING)
-        
-    docs = query.stream()
-    # Добавляем doc_id в каждый документ
-    return [{**doc.to_dict(), 'doc_id': doc.id} for doc in docs]
+async def get_submissions_page(filter_key=None, limit=1):
+    """Первые limit заявок (всех, избранных или отобранных), от новых к старым."""
+    cache_key = (filter_key, limit)
+    cached = _LIST_CACHE.get(cache_key)
+    if cached and time.monotonic() - cached[0] < _CACHE_TTL:
+        return cached[1]
+
+    if filter_key in _MIRROR_COLLECTIONS:
+        query = _get_db().collection(_MIRROR_COLLECTIONS[filter_key]) \
+            .order_by('createdAt', direction=firestore.Query.DESCENDING).limit(limit)
+        mirror_docs = await _run_blocking(list, query.stream())
+        result = await get_submissions_by_ids([doc.id for doc in mirror_docs])
+    else:
+        query = _submissions_collection() \
+            .order_by('createdAt', direction=firestore.Query.DESCENDING).limit(limit)
+        docs = await _run_blocking(list, query.stream())
+        # Добавляем doc_id в каждый документ
+        result = [{**doc.to_dict(), 'doc_id': doc.id} for doc in docs]
+
+    _LIST_CACHE[cache_key] = (time.monotonic(), result)
+    return result
+
+async def count_submissions(filter_key=None):
+    """Количество заявок через агрегацию COUNT() (кэшируется на _COUNT_TTL)."""
+    cached = _COUNT_CACHE.get(filter_key)
+    if cached and time.monotonic() - cached[0] < _COUNT_TTL:
+        return cached[1]
+
+    if filter_key in _MIRROR_COLLECTIONS:
+        query = _get_db().collection(_MIRROR_COLLECTIONS[filter_key])
+    else:
+        query = _submissions_collection()
 
-async def update_submission_status(doc_id, updates):
-    """Обновление статуса (favorite/selected) по doc_id."""
-    submissions_collection.document(doc_id).update(updates)
+    result = await _run_blocking(query.count().get)
+    total = result[0][0].value
+    _COUNT_CACHE[filter_key] = (time.monotonic(), total)
+    return total
+
+async def get_adjacent_submission(direction, created_at=None):
+    """Соседняя заявка относительно createdAt (порядок — от новых к старым).
+
+    Возвращает (заявка, wrapped); wrapped=True, если список пройден до конца
+    и взята первая (для next) или последняя (для prev) заявка.
+    """
+    if direction == 'next':
+        order = firestore.Query.DESCENDING
+    else:
+        order = firestore.Query.ASCENDING
+    query = _submissions_collection().order_by('createdAt', direction=order)
+
+    if created_at is not None:
+        docs = await _run_blocking(list, query.start_after({'createdAt': created_at}).limit(1).stream())
+        if docs:
+            return {**docs[0].to_dict(), 'doc_id': docs[0].id}, False
+
+    docs = await _run_blocking(list, query.limit(1).stream())
+    if not docs:
+        return None, True
+    return {**docs[0].to_dict(), 'doc_id': docs[0].id}, True
+
+async def update_submission_status(entries):
+    """Обновление статусов (favorite/selected) одним WriteBatch.
+
+    entries — список (doc_id, updates, created_at); к каждой записи добавляется
+    updatedAt, а коллекции-зеркала (_MIRROR_COLLECTIONS) обновляются в том же батче.
+    """
+    # На одну заявку — до трёх операций: сама заявка и два зеркала
+    chunk = BATCH_LIMIT // (1 + len(_MIRROR_COLLECTIONS))
+    for start in range(0, len(entries), chunk):
+        db = _get_db()
+        batch = db.batch()
+        for doc_id, updates, created_at in entries[start:start + chunk]:
+            batch.update(
+                db.collection('submissions').document(doc_id),
+                {**updates, 'updatedAt': firestore.SERVER_TIMESTAMP}
+            )
+            for field, collection in _MIRROR_COLLECTIONS.items():
+                if field not in updates:
+                    continue
+                mirror_ref = db.collection(collection).document(doc_id)
+                if updates[field]:
+                    batch.set(mirror_ref, {'doc_id': doc_id, 'createdAt': created_at})
+                else:
+                    batch.delete(mirror_ref)
+        await _run_blocking(batch.commit)
+    _invalidate_cache()
+
+async def get_submissions_by_ids(ids):
+    """Получение нескольких заявок одним запросом (db.get_all) в порядке ids."""
+    if not ids:
+        return []
+
+    db = _get_db()
+    refs = [db.collection('submissions').document(doc_id) for doc_id in ids]
+    docs = await _run_blocking(list, db.get_all(refs))
+
+    # get_all не гарантирует порядок — восстанавливаем его по ids
+    by_id = {doc.id: doc for doc in docs if doc.exists}
+    return [{**by_id[doc_id].to_dict(), 'doc_id': doc_id} for doc_id in ids if doc_id in by_id]
+
+# Один перенос на зеркало за раз
+_MIRROR_LOCKS = {field: asyncio.Lock() for field in _MIRROR_COLLECTIONS}
+
+async def backfill_mirror(filter_key):
+    """Перенос заявок с filter_key == True в коллекцию-зеркало (разовая миграция).
+
+    Нужен для флагов, выставленных до появления зеркал. После копирования
+    удаляет записи зеркала, чья заявка уже без флага или удалена (например,
+    флаг сняли во время переноса). Возвращает (добавлено, удалено).
+    """
+    async with _MIRROR_LOCKS[filter_key]:
+        db = _get_db()
+        mirror = db.collection(_MIRROR_COLLECTIONS[filter_key])
+
+        query = db.collection('submissions').where(filter_key, '==', True).select(['createdAt'])
+        docs = await _run_blocking(list, query.stream())
+        for start in range(0, len(docs), BATCH_LIMIT):
+            batch = db.batch()
+            for doc in docs[start:start + BATCH_LIMIT]:
+                batch.set(mirror.document(doc.id), {'doc_id': doc.id, 'createdAt': doc.get('createdAt')})
+            await _run_blocking(batch.commit)
+
+        mirror_docs = await _run_blocking(list, mirror.stream())
+        flagged = {sub['doc_id'] for sub in await get_submissions_by_ids([doc.id for doc in mirror_docs])
+                   if sub.get(filter_key)}
+        stale = [doc.id for doc in mirror_docs if doc.id not in flagged]
+        for start in range(0, len(stale), BATCH_LIMIT):
+            batch = db.batch()
+            for doc_id in stale[start:start + BATCH_LIMIT]:
+                batch.delete(mirror.document(doc_id))
+            await _run_blocking(batch.commit)
+
+    _invalidate_cache()
+    return len(docs), len(stale)
 
 async def get_submission_by_doc_id(doc_id):
     """Поиск заявки по ID документа."""
-    doc = submissions_collection.document(doc_id).get()
+    doc = await _run_blocking(_submissions_collection().document(doc_id).get)
     if doc.exists:
         data = doc.to_dict()
         data['doc_id'] = doc.id 
@@ -101,6 +291,40 @@ async def get_submission_by_doc_id(doc_id):
 
 # --- 4. ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ БОТА ---
 
+# Кнопки меню менеджера -> filter_key для get_submissions_page
+_FILTER_MAP = {
+    '📋 Все заявки': None,
+    '⭐ Избранные': 'favorite',
+    '🏁 Отобранные': 'selected',
+}
+
+# Тексты кнопок меню для filters.Text (проверка вхождения в frozenset)
+MANAGER_TEXTS = frozenset(_FILTER_MAP)
+
+# Клавиатура менеджера не меняется, строим её один раз
+MANAGER_MENU_MARKUP = ReplyKeyboardMarkup(
+    [
+        [KeyboardButton('📋 Все заявки')],
+        [KeyboardButton('⭐ Избранные'), KeyboardButton('🏁 Отобранные')]
+    ],
+    resize_keyboard=True
+)
+
+# Telegram ограничивает callback_data 64 байтами
+CALLBACK_DATA_LIMIT = 64
+
+# Неизменяемые части навигации
+_NAV_BACK_LABEL = '← Назад'
+_NAV_FWD_LABEL = 'Вперёд →'
+_NOOP_DATA = 'noop'
+
+def _fit_callback_data(*variants):
+    """Первый из вариантов callback_data, который укладывается в CALLBACK_DATA_LIMIT."""
+    for data in variants:
+        if len(data.encode()) <= CALLBACK_DATA_LIMIT:
+            return data
+    raise ValueError(f"❌ callback_data длиннее {CALLBACK_DATA_LIMIT} байт: {variants[-1]}")
+
 def build_keyboard(submission, index=None, total=None):
     """Построение inline-клавиатуры для заявки."""
     fav_label = '⭐ Убрать из избранного' if submission.get('favorite') else '⭐ В избранное'
@@ -108,18 +332,29 @@ def build_keyboard(submission, index=None, total=None):
     
     doc_id = submission.get('doc_id') 
 
+    # createdAt текущей заявки — курсор для постраничного чтения соседней
+    cursor = encode_cursor(submission.get('createdAt'))
+
+    # В кнопки fav/sel кладём позицию, текущие флаги и курсор: переключение
+    # обходится без чтения документа и без пересчёта позиции
+    position = f"{index}:{total}" if index is not None and total is not None else ':'
+    flags = f"{int(bool(submission.get('favorite')))}{int(bool(submission.get('selected')))}"
+    state = f"{position}:{flags}:{cursor}"
+
+    # Если состояние не влезает в лимит, остаются короткие форматы,
+    # которые обработчик тоже понимает (с чтением документа / без курсора)
     keyboard = [
         [
-            InlineKeyboardButton(fav_label, callback_data=f"fav:{doc_id}"),
-            InlineKeyboardButton(sel_label, callback_data=f"sel:{doc_id}"),
+            InlineKeyboardButton(fav_label, callback_data=_fit_callback_data(f"fav:{doc_id}:{state}", f"fav:{doc_id}")),
+            InlineKeyboardButton(sel_label, callback_data=_fit_callback_data(f"sel:{doc_id}:{state}", f"sel:{doc_id}")),
         ]
     ]
 
     if index is not None and total is not None:
         nav_row = [
-            InlineKeyboardButton('← Назад', callback_data=f"prev:{index}"),
-            InlineKeyboardButton(f"{index}/{total}", callback_data='noop'),
-            InlineKeyboardButton('Вперёд →', callback_data=f"next:{index}")
+            InlineKeyboardButton(_NAV_BACK_LABEL, callback_data=_fit_callback_data(f"prev:{index}:{cursor}", f"prev:{index}")),
+            InlineKeyboardButton(f"{index}/{total}", callback_data=_NOOP_DATA),
+            InlineKeyboardButton(_NAV_FWD_LABEL, callback_data=_fit_callback_data(f"next:{index}:{cursor}", f"next:{index}"))
         ]
         keyboard.append(nav_row)
 
@@ -159,12 +394,15 @@ async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return 
 
     # Для менеджера
-    keyboard = [
-        [KeyboardButton('📋 Все заявки')],
-        [KeyboardButton('⭐ Избранные'), KeyboardButton('🏁 Отобранные')]
-    ]
-    reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
-    await update.message.reply_text('Панель менеджера', reply_markup=reply_markup)
+    await update.message.reply_text('Панель менеджера', reply_markup=MANAGER_MENU_MARKUP)
+
+
+async def backfill_mirrors_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Команда менеджера /backfill_mirrors: разовое заполнение зеркал избранного и отбора."""
+    for filter_key, collection in _MIRROR_COLLECTIONS.items():
+        added, removed = await backfill_mirror(filter_key)
+        logger.info(f"✅ Зеркало {collection}: перенесено {added}, удалено {removed}")
+        await update.message.reply_text(f"✅ {collection}: перенесено {added}, удалено {removed}")
 
 
 async def handle_new_submission(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -198,141 +436,242 @@ async def handle_new_submission(update: Update, context: ContextTypes.DEFAULT_TY
 
 
 async def handle_manager_hears(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Обработка кнопок меню менеджера."""
-    if update.effective_chat.id != MANAGER_CHAT_ID:
-        return
+    """Обработка кнопок меню менеджера.
 
+    Чат и текст уже проверены фильтрами обработчика (см. init_application).
+    """
     text = update.message.text
-    filter_key = None
-    
-    if text == '📋 Все заявки':
-        pass
-    elif text == '⭐ Избранные':
-        filter_key = 'favorite'
-    elif text == '🏁 Отобранные':
-        filter_key = 'selected'
-    else:
-        return
+    filter_key = _FILTER_MAP[text]
 
-    list_to_show = await get_submissions_list(filter_key)
+    # Нужна только первая заявка и общее число — без чтения всего списка
+    page, total = await asyncio.gather(
+        get_submissions_page(filter_key, limit=1),
+        count_submissions(filter_key)
+    )
     
-    if not list_to_show:
+    if not page or not total:
         await update.message.reply_text(f"❌ {text} пока нет")
         return
-
-    sub = list_to_show[0]
-    total = len(list_to_show)
     
-    await send_submission(context, update.effective_chat.id, sub, index=1, total=total)
-
-
-async def handle_callback_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Обработка Inline-кнопок (fav, sel, next, prev)."""
-    query = update.callback_query
-    await query.answer()
+    await send_submission(context, update.effective_chat.id, page[0], index=1, total=total)
 
-    data = query.data
-    parts = data.split(':')
-    query_type = parts[0]
-    
-    if query_type == 'noop':
-        return
 
-    # 🔁 Переключение (next/prev)
-    if query_type in ['next', 'prev']:
-        submissions = await get_submissions_list() 
-        current_index_one_based = int(parts[1]) 
-        current_index = current_index_one_based - 1
-        total = len(submissions)
+async def _do_nav(context: ContextTypes.DEFAULT_TYPE, query, direction, current_index, cursor):
+    """Показ соседней заявки (next/prev)."""
+    try:
+        # Счётчик и соседняя заявка не зависят друг от друга — читаем параллельно
+        total, (sub, wrapped) = await asyncio.gather(
+            count_submissions(),
+            get_adjacent_submission(direction, cursor)
+        )
         
-        if not total: return await query.answer("Список пуст")
+        if not total or not sub:
+            logger.info("ℹ️ Список заявок пуст")
+            return
         
-        if query_type == 'next':
-            new_index = (current_index + 1) % total
+        if direction == 'next':
+            new_index = 1 if wrapped else current_index + 1
         else:
-            new_index = (current_index - 1 + total) % total
-
-        sub = submissions[new_index]
-        try:
+            new_index = total if wrapped else current_index - 1
+        # total может немного отставать от реального количества (кэш)
+        new_index = max(1, min(new_index, total))
+
+        # Правим сообщение на месте: один вызов API вместо delete + send
+        keyboard = build_keyboard(sub, new_index, total)
+        if sub['photo'] and query.message.photo:
+            await query.edit_message_media(
+                InputMediaPhoto(sub['photo'], caption=sub['text'], parse_mode=ParseMode.HTML),
+                reply_markup=keyboard
+            )
+        elif not sub['photo'] and not query.message.photo:
+            await query.edit_message_text(sub['text'], parse_mode=ParseMode.HTML, reply_markup=keyboard)
+        else:
+            # Telegram не превращает текстовое сообщение в фото и наоборот
             await query.delete_message()
-            await send_submission(context, query.message.chat_id, sub, new_index + 1, total)
-        except Exception as e:
+            await send_submission(context, query.message.chat_id, sub, new_index, total)
+    except BadRequest as e:
+        # В списке из одной заявки next/prev возвращает ту же заявку — это не ошибка
+        if 'message is not modified' not in str(e).lower():
             logger.error(f"❌ Ошибка при переключении: {e}")
+    except Exception as e:
+        logger.error(f"❌ Ошибка при переключении: {e}")
+
+
+# Нажатия next/prev на одном сообщении за окно _NAV_DEBOUNCE объединяются:
+# выполняется только последнее. Ключ — (chat_id, message_id).
+_NAV_PENDING = {}
+_NAV_DEBOUNCE = 0.15
+
+async def _debounced_nav(key, event):
+    """Выполнение последнего нажатия next/prev для сообщения key.
+
+    Первое нажатие ждёт _NAV_DEBOUNCE и выполняет самое свежее событие;
+    последующие нажатия в этом окне только подменяют событие и возвращаются.
+    Всё происходит внутри обработки обновления, поэтому webhook дожидается правки.
+    """
+    is_first = key not in _NAV_PENDING
+    _NAV_PENDING[key] = event
+    if not is_first:
         return
 
-    # ✅ Обработка fav / sel
-    if query_type in ['fav', 'sel']:
+    try:
+        await asyncio.sleep(_NAV_DEBOUNCE)
+    finally:
+        # Освобождаем ключ даже при отмене (таймаут webhook)
+        event = _NAV_PENDING.pop(key)
+    await _do_nav(*event)
+
+
+async def _do_toggle(query, query_type, parts):
+    """Переключение favorite/selected и обновление клавиатуры."""
+    try:
+        # Формат: fav:{doc_id}:{index}:{total}:{flags}:{cursor}
         doc_id = parts[1] 
+        # Кнопки без позиции: клавиатура будет без навигации
+        index = int(parts[2]) if len(parts) > 3 and parts[2] else None
+        total = int(parts[3]) if len(parts) > 3 and parts[3] else None
         
-        sub = await get_submission_by_doc_id(doc_id)
-        if not sub:
-            return await query.answer("Заявка не найдена")
+        if len(parts) >= 6 and parts[5]:
+            # Текущее состояние и createdAt известны из самой кнопки
+            flags = parts[4]
+            sub = {
+                'doc_id': doc_id,
+                'favorite': flags[0] == '1',
+                'selected': flags[1] == '1',
+                'createdAt': decode_cursor(parts[5]),
+            }
+        else:
+            # Старые кнопки без состояния (или без createdAt для зеркал) — читаем документ
+            sub = await get_submission_by_doc_id(doc_id)
+            if not sub:
+                logger.warning(f"⚠️ Заявка не найдена, ID: {doc_id}")
+                return
 
         updates = {}
         if query_type == 'fav':
-            new_status = not sub.get('favorite', False)
-            updates['favorite'] = new_status
+            updates['favorite'] = not sub.get('favorite', False)
         elif query_type == 'sel':
-            new_status = not sub.get('selected', False)
-            updates['selected'] = new_status
-        
-        if not updates:
-            return await query.answer("Нечего обновлять")
+            updates['selected'] = not sub.get('selected', False)
 
-        await update_submission_status(doc_id, updates)
+        await update_submission_status([(doc_id, updates, sub.get('createdAt'))])
         
         # Обновляем объект для клавиатуры
         sub.update(updates) 
         
-        # Пересчитываем индекс для правильной навигации
-        submissions = await get_submissions_list()
-        total = len(submissions)
-        index = next((i for i, s in enumerate(submissions) if s.get('doc_id') == doc_id), -1)
-        
-        if index != -1:
-            await query.edit_message_reply_markup(
-                reply_markup=build_keyboard(sub, index + 1, total)
-            )
-            await query.answer("✅ Сохранено")
-        else:
-             await query.answer("⚠️ Не удалось обновить")
+        await query.edit_message_reply_markup(
+            reply_markup=build_keyboard(sub, index, total)
+        )
+    except Exception as e:
+        logger.error(f"❌ Ошибка при обновлении заявки: {e}")
+
+
+async def handle_callback_query(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработка Inline-кнопок (fav, sel, next, prev).
+
+    На callback отвечаем сразу (спиннер у менеджера пропадает), а чтение/запись
+    в Firestore и правку сообщения дожидаемся до конца обработки обновления:
+    на Vercel работа после ответа webhook не гарантирована.
+    """
+    query = update.callback_query
+    await query.answer()
+
+    data = query.data
+    parts = data.split(':')
+    query_type = parts[0]
+    
+    if query_type == _NOOP_DATA:
+        return
+
+    # 🔁 Переключение (next/prev)
+    if query_type in ['next', 'prev']:
+        current_index = int(parts[1]) 
+        # Старые кнопки без курсора начинают с начала (или конца) списка
+        cursor = decode_cursor(parts[2]) if len(parts) > 2 else None
+        key = (query.message.chat_id, query.message.message_id)
+        await _debounced_nav(key, (context, query, query_type, current_index, cursor))
+        return
+
+    # ✅ Обработка fav / sel
+    if query_type in ['fav', 'sel']:
+        await _do_toggle(query, query_type, parts)
 
 
 # --- 6. НАСТРОЙКА WEBHOOK (для Vercel) ---
 
 def init_application():
     """Инициализация и настройка обработчиков."""
-    application = Application.builder().token(BOT_TOKEN).build()
+    # Больший пул соединений и HTTP/2, чтобы одновременные вызовы Bot API
+    # (несколько менеджеров, фоновые задачи) не ждали свободного соединения
+    bot_request = HTTPXRequest(
+        connection_pool_size=64,
+        pool_timeout=5.0,
+        connect_timeout=5.0,
+        read_timeout=20.0,
+        http_version='2'
+    )
+    application = Application.builder().token(BOT_TOKEN).request(bot_request).build()
     
     # Добавление обработчиков
     application.add_handler(CommandHandler("start", start_command))
+    application.add_handler(CommandHandler(
+        "backfill_mirrors", backfill_mirrors_command, filters=filters.Chat(MANAGER_CHAT_ID)
+    ))
     application.add_handler(MessageHandler(
         filters.ALL & ~filters.Chat(MANAGER_CHAT_ID), 
         handle_new_submission
     ))
     application.add_handler(MessageHandler(
-        filters.Chat(MANAGER_CHAT_ID) & filters.Text(['📋 Все заявки', '⭐ Избранные', '🏁 Отобранные']),
+        filters.Chat(MANAGER_CHAT_ID) & filters.Text(MANAGER_TEXTS),
         handle_manager_hears
     ))
     application.add_handler(CallbackQueryHandler(handle_callback_query))
     
     return application
 
+# Максимальное время обработки одного обновления (секунды)
+WEBHOOK_TIMEOUT = 25
+
+def start_event_loop(application):
+    """Запуск постоянного event loop в фоновом потоке.
+
+    Один loop на весь процесс: пул соединений HTTPX бота и каналы gRPC
+    переиспользуются между запросами, а не создаются заново на каждый webhook.
+    """
+    loop = asyncio.new_event_loop()
+    loop.run_until_complete(application.initialize())
+
+    def run_forever():
+        asyncio.set_event_loop(loop)
+        loop.run_forever()
+
+    threading.Thread(target=run_forever, name='telegram-event-loop', daemon=True).start()
+    return loop
+
 # Создание Flask-приложения и инициализация Telegram Application
 app = Flask(__name__)
 application = init_application()
+loop = start_event_loop(application)
 
 @app.route('/', defaults={'path': ''}, methods=['GET', 'POST'])
 @app.route('/<path:path>', methods=['GET', 'POST'])
-async def telegram_webhook(path):
+def telegram_webhook(path):
     """Основной Webhook-эндпоинт для Telegram."""
     if request.method == "POST":
+        # Firestore нужен только при обработке обновлений
+        _get_db()
+
         # Обработка обновления от Telegram
         update = Update.de_json(request.get_json(force=True), application.bot)
         
-        # ⚠️ ВАЖНО: Flask по умолчанию синхронный. Мы явно запускаем асинхронный метод
-        # application.process_update в event loop.
-        asyncio.run(application.process_update(update))
+        # ⚠️ ВАЖНО: Flask по умолчанию синхронный. Передаём application.process_update
+        # в постоянный event loop и ждём результата.
+        fut = asyncio.run_coroutine_threadsafe(application.process_update(update), loop)
+        try:
+            fut.result(timeout=WEBHOOK_TIMEOUT)
+        except concurrent.futures.TimeoutError:
+            # Отвечаем 200, иначе Telegram пришлёт обновление повторно (дубли заявок)
+            fut.cancel()
+            logger.error(f"❌ Обновление {update.update_id} не обработано за {WEBHOOK_TIMEOUT} с")
         
         return jsonify({"status": "ok"})
     